@@ -4,13 +4,17 @@ import sys
 import json
 import webbrowser
 import threading
-import queue
-import io
-import contextlib
+import collections
 from threading import Timer
-from flask import Flask, render_template, request, Response, jsonify
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, render_template, request, Response, stream_with_context
 from waitress import serve
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Helper to find resources in bundled apps (PyInstaller)
 def resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
@@ -29,6 +33,23 @@ app = Flask(__name__,
             template_folder=resource_path('templates'),
             static_folder=resource_path('static'))
 
+# Defaults for the file browser; neither changes while the app is running
+_CWD = os.getcwd()
+_HOME = os.path.expanduser("~")
+
+def _json(obj, status=200):
+    """ Serialize obj to a JSON response, using orjson when it is installed """
+    if orjson is not None:
+        try:
+            body = orjson.dumps(obj)
+        except TypeError:
+            # File names that are not valid UTF-8 come back from os.scandir with
+            # surrogate escapes, which orjson rejects; json.dumps escapes them
+            body = json.dumps(obj)
+    else:
+        body = json.dumps(obj)
+    return Response(body, status=status, mimetype='application/json')
+
 # --- API Endpoints ---
 # ... (rest of the file remains the same until the runner)
 
@@ -38,93 +59,123 @@ def index():
 
 @app.route('/api/ls')
 def list_dir():
-    path = request.args.get('path', os.getcwd())
+    path = request.args.get('path', _CWD)
     if not os.path.exists(path):
         # Try to find a valid parent
-        path = os.path.expanduser("~")
+        path = _HOME
     
     try:
-        items = []
+        # A single scandir pass; DirEntry.is_dir() reuses the dirent type
+        with os.scandir(path) as it:
+            entries = [(e.name, e.path, e.is_dir()) for e in it]
         # Sort so directories come first
-        all_items = sorted(os.listdir(path), key=lambda x: (not os.path.isdir(os.path.join(path, x)), x.lower()))
-        
-        for item in all_items:
-            full_path = os.path.join(path, item)
-            items.append({
-                "name": item,
-                "path": full_path,
-                "is_dir": os.path.isdir(full_path)
-            })
-        return jsonify({
+        entries.sort(key=lambda t: (not t[2], t[0].lower()))
+
+        items = [{"name": name, "path": full_path, "is_dir": is_dir}
+                 for name, full_path, is_dir in entries]
+        return _json({
             "current_path": os.path.abspath(path),
             "items": items
         })
     except Exception as e:
-        return jsonify({"error": str(e)}), 400
+        return _json({"error": str(e)}, status=400)
 
 @app.route('/api/mkdir', methods=['POST'])
 def make_dir():
-    data = request.json
-    path = data.get('path')
-    name = data.get('name')
-    new_path = os.path.join(path, name)
     try:
+        raw = request.get_data(cache=False)
+        data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+        path = data.get('path')
+        name = data.get('name')
+        new_path = os.path.join(path, name)
         os.makedirs(new_path, exist_ok=True)
-        return jsonify({"success": True})
+        return _json({"success": True})
     except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 400
+        return _json({"success": False, "error": str(e)}, status=400)
 
 # --- Runner Endpoints with Streaming ---
 
-class StreamProcessor(io.StringIO):
+class StreamProcessor:
+    """ Minimal file-like object forwarding printed lines to a runner queue """
     def __init__(self, q):
-        super().__init__()
         self.q = q
     def write(self, s):
-        if s.strip():
-            self.q.put(s.strip())
-        return super().write(s)
+        line = s.strip()
+        if line:
+            self.q.put(line)
+        return len(s)
+    def flush(self):
+        pass
 
 def run_in_thread(func, args, q):
-    # Capture stdout and stderr
-    with contextlib.redirect_stdout(StreamProcessor(q)):
-        with contextlib.redirect_stderr(StreamProcessor(q)):
-            try:
-                func(*args)
-            except Exception as e:
-                print(f"Error: {str(e)}")
+    # Capture stdout and stderr into one shared processor
+    sp = StreamProcessor(q)
+    old_out, old_err = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = sp
+    try:
+        func(*args)
+    except Exception as e:
+        print(f"Error: {str(e)}")
+    finally:
+        sys.stdout, sys.stderr = old_out, old_err
     q.put("[DONE]")
 
+class MessageQueue:
+    """Single-producer/single-consumer channel between a runner and its SSE stream."""
+    def __init__(self):
+        self.messages = collections.deque()
+        self.ready = threading.Event()
+    def put(self, msg):
+        # deque.append is thread-safe; the event only wakes the consumer
+        self.messages.append(msg)
+        self.ready.set()
+
+# Runner jobs share a small pool instead of spawning a thread per request
+_RUNNER_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="runner")
+
+# Seconds of silence after which an SSE comment is sent to keep the stream flushing
+_KEEPALIVE_INTERVAL = 5
+
 def stream_from_queue(q):
     while True:
-        msg = q.get()
-        if msg == "[DONE]":
-            yield "data: [DONE]\n\n"
-            break
-        yield f"data: {msg}\n\n"
+        if not q.ready.wait(timeout=_KEEPALIVE_INTERVAL):
+            yield ": keepalive\n\n"
+            continue
+        q.ready.clear()
+        while q.messages:
+            msg = q.messages.popleft()
+            if msg == "[DONE]":
+                yield "data: [DONE]\n\n"
+                return
+            yield f"data: {msg}\n\n"
+
+def event_stream_response(q):
+    return Response(stream_with_context(stream_from_queue(q)),
+                    mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache'})
 
 @app.route('/run/reorganize')
 def run_reorganize():
     path = request.args.get('path')
-    q = queue.Queue()
-    threading.Thread(target=run_in_thread, args=(reorganize_data, [path], q)).start()
-    return Response(stream_from_queue(q), mimetype='text/event-stream')
+    q = MessageQueue()
+    _RUNNER_POOL.submit(run_in_thread, reorganize_data, [path], q)
+    return event_stream_response(q)
 
 @app.route('/run/map-ids')
 def run_map_ids():
     conn = request.args.get('conn')
     bids = request.args.get('bids')
-    q = queue.Queue()
-    threading.Thread(target=run_in_thread, args=(map_conn_ids.run_mapping, [conn, bids], q)).start()
-    return Response(stream_from_queue(q), mimetype='text/event-stream')
+    q = MessageQueue()
+    _RUNNER_POOL.submit(run_in_thread, map_conn_ids.run_mapping, [conn, bids], q)
+    return event_stream_response(q)
 
 @app.route('/run/export')
 def run_export():
     source = request.args.get('source')
     dest = request.args.get('dest')
-    q = queue.Queue()
-    threading.Thread(target=run_in_thread, args=(export_light, [source, dest], q)).start()
-    return Response(stream_from_queue(q), mimetype='text/event-stream')
+    q = MessageQueue()
+    _RUNNER_POOL.submit(run_in_thread, export_light, [source, dest], q)
+    return event_stream_response(q)
 
 if __name__ == '__main__':
     port = 5000
@@ -138,7 +189,10 @@ if __name__ == '__main__':
             print(f"Starting CONN Tool Manager at http://localhost:{port}")
             # Start a timer to open the browser shortly after the server starts
             Timer(1.5, open_browser, args=[port]).start()
-            serve(app, host='0.0.0.0', port=port)
+            # Each /run/* stream holds a worker thread for the whole job,
+            # so keep enough threads free for file-browser requests
+            serve(app, host='0.0.0.0', port=port, threads=16, connection_limit=256,
+                  channel_timeout=120, asyncore_use_poll=True)
             break
         except OSError as e:
             if e.errno == 48 or (os.name == 'nt' and e.errno == 10048):
@@ -4,6 +4,11 @@ import os
 import re
 import csv
 import sys
+import mmap
+import shutil
+
+# CONN import log line; bytes pattern so it can scan the memory-mapped log in one pass
+IMPORT_RE = re.compile(rb'sub-([A-Za-z0-9]+)[^\n]*imported to subject ([0-9]+)')
 
 def run_mapping(conn_path, bids_dir):
     conn_mat = os.path.abspath(conn_path)
@@ -21,86 +26,89 @@ def run_mapping(conn_path, bids_dir):
     conn_name = os.path.splitext(os.path.basename(conn_mat))[0]
     conn_dir = os.path.dirname(conn_mat)
     log_path = os.path.join(conn_dir, conn_name, 'logfile.txt')
-    
-    if not os.path.exists(log_path):
-        print(f"Error: CONN log file not found at expected location: {log_path}")
-        return
-        
     participants_tsv = os.path.join(bids_dir, 'participants.tsv')
-    if not os.path.exists(participants_tsv):
-        print(f"Error: participants.tsv not found in {bids_dir}")
-        return
         
     # 1. Parse log file for mapping
     # Searching for: "functional ...sub-134001... imported to subject 1 session 1"
     mapping = {}
     print(f"Reading log file: {log_path}")
-    with open(log_path, 'r', encoding='utf-8', errors='ignore') as f:
-        for line in f:
-            # Match both sub-[0-9]+ and subject [0-9]+
-            match = re.search(r'sub-([A-Za-z0-9]+).*imported to subject ([0-9]+)', line)
-            if match:
-                bids_id = 'sub-' + match.group(1)
-                conn_id = match.group(2)
-                mapping[bids_id] = conn_id
+    try:
+        f = open(log_path, 'rb')
+    except FileNotFoundError:
+        print(f"Error: CONN log file not found at expected location: {log_path}")
+        return
+    with f:
+        # mmap cannot map an empty file
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for match in IMPORT_RE.finditer(mm):
+                    bids_id = 'sub-' + match.group(1).decode('ascii')
+                    conn_id = match.group(2).decode('ascii')
+                    mapping[bids_id] = conn_id
 
+    output_filename = 'participants_with_conn.tsv'
+    output_path = os.path.join(conn_dir, output_filename)
+    
     if not mapping:
         print("Warning: No mappings found in log file. Check if data import is logged correctly.")
-    else:
-        print(f"Found {len(mapping)} participant mappings.")
+        # Nothing to merge, so skip the TSV rewrite
+        try:
+            shutil.copyfile(participants_tsv, output_path)
+        except FileNotFoundError:
+            print(f"Error: participants.tsv not found in {bids_dir}")
+            return
+        print(f"Copied participants list unchanged to: {output_path}")
+        return
+    print(f"Found {len(mapping)} participant mappings.")
 
-    # 2. Read participants.tsv and add/update conn_id
-    output_rows = []
-    
+    # 2. Stream participants.tsv, adding/updating conn_id, straight into the CONN folder
     print(f"Reading BIDS participants: {participants_tsv}")
-    with open(participants_tsv, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-        if not lines:
+    try:
+        fin = open(participants_tsv, 'r', encoding='utf-8', newline='', buffering=1 << 16)
+    except FileNotFoundError:
+        print(f"Error: participants.tsv not found in {bids_dir}")
+        return
+    with fin:
+        # QUOTE_NONE keeps BIDS TSV cells verbatim (no quote interpretation)
+        reader = csv.reader(fin, delimiter='\t', quoting=csv.QUOTE_NONE)
+        header = next(reader, None)
+        if not header:
             print("Error: participants.tsv is empty.")
             return
             
-        header = lines[0].strip().split('\t')
-        conn_id_idx = -1
-        if 'conn_id' in header:
+        try:
             conn_id_idx = header.index('conn_id')
             print("Note: 'conn_id' column already exists. Updating values.")
-        else:
+        except ValueError:
+            conn_id_idx = -1
             header.append('conn_id')
+        
+        with open(output_path, 'w', encoding='utf-8', newline='', buffering=1 << 16) as fout:
+            writer = csv.writer(fout, delimiter='\t', quoting=csv.QUOTE_NONE,
+                                quotechar=None, lineterminator='\n')
+            writer.writerow(header)
             
-        for line in lines[1:]:
-            parts = line.strip().split('\t')
-            if not parts:
-                continue
-            
-            participant_id = parts[0]
-            conn_id = mapping.get(participant_id, 'n/a')
+            # Width a row must have before conn_id is appended to it
+            pad_to = conn_id_idx if conn_id_idx != -1 else len(header) - 1
+            get_conn_id = mapping.get
             
-            if conn_id_idx != -1:
-                # Update existing column
-                if len(parts) > conn_id_idx:
+            for parts in reader:
+                if not parts:
+                    continue
+                
+                participant_id = parts[0]
+                conn_id = get_conn_id(participant_id, 'n/a')
+                
+                if conn_id_idx != -1 and len(parts) > conn_id_idx:
+                    # Update existing column
                     parts[conn_id_idx] = conn_id
                 else:
-                    # Pad if row was shorter than header
-                    while len(parts) < conn_id_idx:
-                        parts.append('n/a')
+                    # Pad short rows up to the conn_id column, then append it
+                    if len(parts) < pad_to:
+                        parts.extend(['n/a'] * (pad_to - len(parts)))
                     parts.append(conn_id)
-            else:
-                # Append new column
-                # Ensure the row has enough columns for the padding if needed
-                while len(parts) < len(header) - 1:
-                    parts.append('n/a')
-                parts.append(conn_id)
-                
-            output_rows.append('\t'.join(parts))
-
-    # 3. Save to CONN folder
-    output_filename = 'participants_with_conn.tsv'
-    output_path = os.path.join(conn_dir, output_filename)
-    
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write('\t'.join(header) + '\n')
-        for row in output_rows:
-            f.write(row + '\n')
+                    
+                writer.writerow(parts)
             
     print(f"Successfully saved updated participants list to: {output_path}")
 
@@ -18,12 +18,21 @@ import os
 import argparse
 import json
 import re
+import fnmatch
+import gzip
+import zlib
+import math
+import struct
 import subprocess
 import tempfile
 import shutil
+import time
+import functools
+import heapq
 from pathlib import Path
-from datetime import datetime
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from scripts_py.read_bids_metadata import BIDSMetadataReader
 
 # Colors for output
 class Colors:
@@ -46,26 +55,35 @@ def print_header():
 """
     print(header)
 
+# Default color per log level (anything else is CYAN)
+LEVEL_COLORS = {
+    "ERROR": Colors.RED,
+    "WARNING": Colors.YELLOW,
+    "SUCCESS": Colors.GREEN,
+}
+
 def log(message, level="INFO", color=None):
     """Print timestamped log message"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
     if color is None:
-        if level == "ERROR":
-            color = Colors.RED
-        elif level == "WARNING":
-            color = Colors.YELLOW
-        elif level == "SUCCESS":
-            color = Colors.GREEN
-        else:
-            color = Colors.CYAN
+        color = LEVEL_COLORS.get(level, Colors.CYAN)
     
     print(f"{color}[{timestamp}] {level}: {message}{Colors.ENDC}")
 
-def tail_file(path, line_count=200):
-    """Return the last N lines of a text file."""
+def tail_file(path, line_count=200, block=65536):
+    """Return the last N lines of a text file, reading only its end."""
     try:
-        with open(path, 'r', errors='ignore') as handle:
-            return ''.join(deque(handle, maxlen=line_count))
+        with open(path, 'rb') as handle:
+            size = os.fstat(handle.fileno()).st_size
+            while True:
+                start = max(0, size - block)
+                handle.seek(start)
+                lines = handle.read().splitlines(True)
+                # The first line may be cut off unless the read started at the beginning
+                if start == 0 or len(lines) > line_count:
+                    break
+                block *= 2
+        return b''.join(lines[-line_count:]).decode('utf-8', 'ignore')
     except Exception as exc:
         return f"[Unable to read {path}: {exc}]\n"
 
@@ -84,27 +102,51 @@ def append_conn_project_logs(project_dir, log_file):
                 handle.write(f"\n[{entry}]\n")
                 handle.write(tail_file(fullpath))
 
+SUBJECT_SESSION_RE = re.compile(r"Subject\s+(\d+)\s+Session\s+(\d+)")
+
 def extract_failure_subject_session(stdout_content):
     """Extract last 'Subject X Session Y' from CONN output if present."""
-    matches = re.findall(r"Subject\s+(\d+)\s+Session\s+(\d+)", stdout_content)
-    if not matches:
-        return None, None
-    subject_str, session_str = matches[-1]
+    # Scan backwards from the end so only the tail of a long output is examined
+    pos = len(stdout_content)
+    while True:
+        pos = stdout_content.rfind("Subject", 0, pos)
+        if pos < 0:
+            return None, None
+        match = SUBJECT_SESSION_RE.match(stdout_content, pos)
+        if match:
+            break
     try:
-        return int(subject_str), int(session_str)
+        return int(match.group(1)), int(match.group(2))
     except ValueError:
         return None, None
 
-def append_subject_diagnostics(log_file, fmriprep_dir, subject_index, session_index, sessions=None):
+def _scan_files(directory, pattern):
+    """Return sorted (path, size) pairs for files in directory matching pattern."""
+    try:
+        with os.scandir(directory) as it:
+            # Each size is read once here (a stat on POSIX, free from the directory
+            # listing on Windows) so the diagnostics below never stat again
+            entries = [(Path(e.path), e.stat().st_size) for e in it
+                       if fnmatch.fnmatchcase(e.name, pattern) and e.is_file()]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+    return sorted(entries)
+
+def append_subject_diagnostics(log_file, fmriprep_dir, subject_index, session_index, sessions=None, deep_check=False):
     """Append subject/session file diagnostics to the pipeline log."""
     if subject_index is None or session_index is None:
         return
 
-    subject_dirs = sorted([p for p in Path(fmriprep_dir).glob('sub-*') if p.is_dir()])
-    if subject_index < 1 or subject_index > len(subject_dirs):
+    if subject_index < 1:
+        return
+    # Only the first subject_index names in sorted order are needed, not a full sort
+    with os.scandir(fmriprep_dir) as it:
+        subject_names = heapq.nsmallest(
+            subject_index, (e.name for e in it if e.name.startswith('sub-') and e.is_dir()))
+    if subject_index > len(subject_names):
         return
 
-    subject_dir = subject_dirs[subject_index - 1]
+    subject_dir = Path(fmriprep_dir) / subject_names[-1]
     session_label = None
     if sessions and session_index <= len(sessions):
         session_label = sessions[session_index - 1]
@@ -113,15 +155,11 @@ def append_subject_diagnostics(log_file, fmriprep_dir, subject_index, session_in
 
     func_dir = subject_dir / session_label / 'func'
     anat_dir = subject_dir / 'anat'
-    func_files = []
-    if func_dir.is_dir():
-        func_files = sorted(func_dir.glob('*space-MNI152NLin2009cAsym*desc-preproc_bold.nii.gz'))
+    func_files = _scan_files(func_dir, '*space-MNI152NLin2009cAsym*desc-preproc_bold.nii.gz')
 
-    anat_files = []
-    if anat_dir.is_dir():
-        anat_files = sorted(anat_dir.glob('*space-MNI152NLin2009cAsym*T1w.nii.gz'))
-        if not anat_files:
-            anat_files = sorted(anat_dir.glob('*_T1w.nii.gz'))
+    anat_files = _scan_files(anat_dir, '*space-MNI152NLin2009cAsym*T1w.nii.gz')
+    if not anat_files:
+        anat_files = _scan_files(anat_dir, '*_T1w.nii.gz')
 
     with open(log_file, 'a') as handle:
         handle.write('\n--- Subject/session diagnostics ---\n')
@@ -133,58 +171,125 @@ def append_subject_diagnostics(log_file, fmriprep_dir, subject_index, session_in
         handle.write('\n[Functional files]\n')
         if not func_files:
             handle.write('  (none found)\n')
-        for f in func_files:
-            handle.write(f"  {f} ({f.stat().st_size} bytes)\n")
+        for f, size in func_files:
+            handle.write(f"  {f} ({size} bytes)\n")
 
         handle.write('\n[Structural files]\n')
         if not anat_files:
             handle.write('  (none found)\n')
-        for f in anat_files:
-            handle.write(f"  {f} ({f.stat().st_size} bytes)\n")
+        for f, size in anat_files:
+            handle.write(f"  {f} ({size} bytes)\n")
 
         try:
             import nibabel as nib
-            import numpy as np
-            handle.write('\n[NIfTI read check]\n')
-            for f in func_files + anat_files:
-                try:
-                    img = nib.load(str(f))
-                    _ = np.asanyarray(img.dataobj[..., 0])
-                    handle.write(f"  OK: {f} shape={img.shape}\n")
-                except Exception as exc:
-                    handle.write(f"  FAIL: {f} error={exc}\n")
-        except Exception as exc:
-            handle.write(f"\n[NIfTI read check unavailable: {exc}]\n")
-    
+        except ImportError as exc:
+            handle.write(f"\n[NIfTI read check skipped: {exc}]\n")
+            return
 
-def validate_fmriprep_derivatives(fmriprep_dir):
-    """Run gunzip -t on key fMRIprep outputs to catch corrupt volumes early."""
-    log("Validating fMRIprep derivative files...", "INFO")
-    patterns = [
-        "**/*desc-preproc_bold.nii.gz",
-        "**/*space-MNI152NLin2009cAsym*T1w.nii.gz",
-        "**/*_T1w.nii.gz",
-    ]
-    base_path = Path(fmriprep_dir)
+        def check(f):
+            try:
+                img = nib.load(str(f))
+                shape = img.header.get_data_shape()
+                if deep_check:
+                    # Slicing the proxy decompresses up to the first volume, so only on request
+                    _ = img.dataobj[..., 0]
+                return f"  OK: {f} shape={shape}\n"
+            except Exception as exc:
+                return f"  FAIL: {f} error={exc}\n"
+
+        # Opens are latency-bound on network storage, so overlap them; results keep file order
+        handle.write('\n[NIfTI read check]\n')
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            for line in executor.map(check, [f for f, _ in func_files + anat_files]):
+                handle.write(line)
+    
+
+def _gzip_test(filepath):
+    """Decompress one file in-process; return (filepath, error detail or None)."""
+    try:
+        # Reading to EOF makes gzip verify the CRC32 and ISIZE trailer
+        with gzip.open(filepath, 'rb') as gz:
+            while gz.read(1 << 20):
+                pass
+    except (OSError, EOFError, zlib.error) as exc:
+        return filepath, str(exc) or type(exc).__name__
+    return filepath, None
+
+def _nifti1_file_size(header):
+    """Uncompressed .nii size implied by a NIfTI-1 header, or None if not NIfTI-1."""
+    if len(header) < 348:
+        return None
+    for endian in '<>':
+        if struct.unpack(endian + 'i', header[:4])[0] == 348:
+            break
+    else:
+        return None
+    dims = struct.unpack(endian + '8h', header[40:56])
+    if not 1 <= dims[0] <= 7:
+        return None
+    bitpix = struct.unpack(endian + 'h', header[72:74])[0]
+    vox_offset = struct.unpack(endian + 'f', header[108:112])[0]
+    if not math.isfinite(vox_offset):
+        # A garbage offset gives no size to compare against
+        return None
+    return int(vox_offset) + math.prod(dims[1:dims[0] + 1]) * bitpix // 8
+
+def _quick_gzip_test(filepath):
+    """Check gzip magic, first block and trailer only; return (filepath, error detail or None)."""
+    # Far cheaper than a full inflate, but without a CRC check it only catches
+    # truncated or mislabelled files, not every corruption
+    try:
+        with open(filepath, 'rb') as f:
+            head = f.read(1 << 16)
+            if head[:3] != b'\x1f\x8b\x08':
+                return filepath, "not a gzip file (bad magic)"
+            f.seek(-8, os.SEEK_END)
+            _, isize = struct.unpack('<II', f.read(8))
+        # Inflating the start confirms the stream parses and yields the NIfTI header
+        header = zlib.decompressobj(31).decompress(head, 352)
+    except (OSError, zlib.error, struct.error) as exc:
+        return filepath, str(exc) or type(exc).__name__
+
+    # ISIZE is the uncompressed size mod 2**32; a truncated file ends in arbitrary bytes
+    expected = _nifti1_file_size(header)
+    if expected is not None and expected % (1 << 32) != isize:
+        # ISIZE only covers the last member of a multi-member stream (bgzip,
+        # concatenated gzip), so let a full decompress decide before failing
+        _, error = _gzip_test(filepath)
+        if error is not None:
+            return filepath, f"gzip trailer size {isize} does not match NIfTI header ({expected} bytes): {error}"
+    return filepath, None
+
+# File name patterns of the fMRIprep outputs checked before import, as one regex
+DERIVATIVE_RE = re.compile('|'.join(fnmatch.translate(pattern) for pattern in (
+    "*desc-preproc_bold.nii.gz",
+    "*space-MNI152NLin2009cAsym*T1w.nii.gz",
+    "*_T1w.nii.gz",
+)))
+
+def _collect_derivative_files(root):
+    """Walk root once and return the sorted files whose name matches DERIVATIVE_RE."""
+    files = []
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if DERIVATIVE_RE.match(name):
+                filepath = os.path.join(dirpath, name)
+                if os.path.isfile(filepath):
+                    files.append(Path(filepath))
+    return sorted(files)
+
+def validate_fmriprep_derivatives(fmriprep_dir, quick=False):
+    """Check gzip integrity of key fMRIprep outputs to catch corrupt volumes early."""
+    log("Validating fMRIprep derivative files" + (" (quick check)..." if quick else "..."), "INFO")
+    check = _quick_gzip_test if quick else _gzip_test
+    files = _collect_derivative_files(fmriprep_dir)
     errors = []
 
-    for pattern in patterns:
-        for filepath in sorted(base_path.rglob(pattern)):
-            if not filepath.is_file():
-                continue
-            try:
-                result = subprocess.run(
-                    ["gunzip", "-t", str(filepath)],
-                    capture_output=True,
-                    text=True,
-                    timeout=20
-                )
-            except subprocess.TimeoutExpired:
-                errors.append((filepath, "timeout"))
-                continue
-
-            if result.returncode != 0:
-                detail = result.stderr.strip() or result.stdout.strip() or "unknown"
+    # zlib releases the GIL while inflating, so the checks scale across threads
+    max_workers = min(32, (os.cpu_count() or 1) * 2)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for filepath, detail in executor.map(check, files):
+            if detail is not None:
                 errors.append((filepath, detail))
 
     if errors:
@@ -196,37 +301,45 @@ def validate_fmriprep_derivatives(fmriprep_dir):
     log("Validated fMRIprep derivatives (BOLD + structural files)", "SUCCESS")
     return True
 
-def extract_bids_metadata(bids_dir, script_dir):
+def extract_bids_metadata(bids_dir):
     """Extract metadata from BIDS dataset"""
     log("Extracting metadata from BIDS dataset...")
     
-    metadata_script = os.path.join(script_dir, 'scripts_py', 'read_bids_metadata.py')
-    
     try:
-        result = subprocess.run(
-            ['python3', metadata_script, bids_dir, '--json'],
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
-        
-        if result.returncode != 0:
-            log(f"BIDS metadata extraction failed: {result.stderr}", "WARNING")
-            return None
-        
-        metadata = json.loads(result.stdout)
-        return metadata
-        
-    except subprocess.TimeoutExpired:
-        log("BIDS metadata extraction timed out", "WARNING")
-        return None
-    except json.JSONDecodeError as e:
-        log(f"Failed to parse BIDS metadata: {e}", "WARNING")
-        return None
+        return BIDSMetadataReader(bids_dir).get_acquisition_parameters()
     except Exception as e:
         log(f"Error extracting BIDS metadata: {e}", "WARNING")
         return None
 
+# Metadata from a previous run, stored in the project directory
+BIDS_METADATA_CACHE = '.bids_metadata.json'
+
+def load_cached_bids_metadata(project_dir, bids_dir):
+    """Return cached BIDS metadata if the BIDS directory is unchanged since it was saved"""
+    cache_path = os.path.join(project_dir, BIDS_METADATA_CACHE)
+    try:
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+        if (cached.get('bids_dir') == bids_dir
+                and cached.get('bids_mtime_ns') == os.stat(bids_dir).st_mtime_ns):
+            return cached.get('metadata')
+    except (OSError, ValueError, AttributeError):
+        pass
+    return None
+
+def save_bids_metadata_cache(project_dir, bids_dir, metadata):
+    """Store BIDS metadata in the project directory, keyed by the BIDS directory mtime"""
+    cache_path = os.path.join(project_dir, BIDS_METADATA_CACHE)
+    try:
+        with open(cache_path, 'w') as f:
+            json.dump({
+                'bids_dir': bids_dir,
+                'bids_mtime_ns': os.stat(bids_dir).st_mtime_ns,
+                'metadata': metadata,
+            }, f, indent=2)
+    except OSError as e:
+        log(f"Could not cache BIDS metadata: {e}", "WARNING")
+
 def validate_paths(args):
     """Validate input paths"""
     errors = []
@@ -248,15 +361,21 @@ def validate_paths(args):
     
     return True
 
+@functools.lru_cache(maxsize=None)
+def _substitution_pattern(keys):
+    """Compile one alternation regex matching any of keys, longest first"""
+    return re.compile('|'.join(re.escape(key) for key in sorted(keys, key=len, reverse=True)))
+
 def create_matlab_script(template_path, output_path, substitutions):
     """Create MATLAB script with variable substitutions"""
     try:
         with open(template_path, 'r') as f:
             content = f.read()
         
-        # Perform substitutions
-        for key, value in substitutions.items():
-            content = content.replace(key, str(value))
+        # Perform all substitutions in a single pass over the template
+        if substitutions:
+            pattern = _substitution_pattern(tuple(substitutions))
+            content = pattern.sub(lambda m: str(substitutions[m.group(0)]), content)
         
         # Write output script
         with open(output_path, 'w') as f:
@@ -267,7 +386,7 @@ def create_matlab_script(template_path, output_path, substitutions):
         log(f"Failed to create MATLAB script: {e}", "ERROR")
         return False
 
-def run_matlab_step(step_num, step_name, batch_script, conn_runner, project_dir, log_file, fmriprep_dir=None, sessions=None):
+def run_matlab_step(step_num, step_name, batch_script, conn_runner, project_dir, log_file, fmriprep_dir=None, sessions=None, deep_check=False):
     """Run a MATLAB batch step with streamed output"""
     log(f"Step {step_num}: {step_name}", "INFO", Colors.BLUE)
     log("=" * 70, "INFO")
@@ -283,33 +402,44 @@ def run_matlab_step(step_num, step_name, batch_script, conn_runner, project_dir,
             shell=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
-            universal_newlines=True
+            bufsize=0
         )
 
-        stdout_lines = []
-        while True:
-            line = process.stdout.readline()
-            if not line and process.poll() is not None:
-                break
-            if line:
-                print(line, end='')
-                stdout_lines.append(line)
+        # Relay output in raw blocks to the terminal and the pipeline log as it arrives
+        block_size = 65536
+        fd = process.stdout.fileno()
+        out = sys.stdout.buffer
+        sys.stdout.flush()
+        stdout_bytes = bytearray()
+        with open(log_file, 'ab') as log_handle:
+            log_handle.write(f"\n[Step {step_num}] {step_name}\nCommand: {cmd}\n".encode())
+            pending = 0
+            while True:
+                chunk = os.read(fd, block_size)
+                if not chunk:
+                    break
+                out.write(chunk)
+                log_handle.write(chunk)
+                stdout_bytes += chunk
+                pending += len(chunk)
+                # Flush once the pipe is drained (short read) or 64 KiB has built up
+                if len(chunk) < block_size or pending >= block_size:
+                    out.flush()
+                    pending = 0
+            out.flush()
+        process.stdout.close()
 
-        stdout_content = ''.join(stdout_lines)
         return_code = process.wait()
 
-        if return_code != 0 or "Error" in stdout_content or "ERROR" in stdout_content:
+        if return_code != 0 or b"Error" in stdout_bytes or b"ERROR" in stdout_bytes:
             log(f"Step {step_num} FAILED", "ERROR")
             with open(log_file, 'a') as f:
                 f.write(f"\n[FAILED] Step {step_num}: {step_name}\n")
-                f.write(f"Command: {cmd}\n")
-                f.write(stdout_content)
             append_conn_project_logs(project_dir, log_file)
             if fmriprep_dir:
+                stdout_content = stdout_bytes.decode('utf-8', 'replace')
                 subject_index, session_index = extract_failure_subject_session(stdout_content)
-                append_subject_diagnostics(log_file, fmriprep_dir, subject_index, session_index, sessions)
+                append_subject_diagnostics(log_file, fmriprep_dir, subject_index, session_index, sessions, deep_check)
             return False
 
         log(f"Step {step_num} COMPLETED", "SUCCESS")
@@ -352,6 +482,10 @@ Examples:
                         help='Path to pipeline configuration JSON file')
     parser.add_argument('--no-qa', action='store_true',
                         help='Do not generate QA plots')
+    parser.add_argument('--quick-validate', action='store_true',
+                        help='Validate fMRIprep gzip files from header and trailer only instead of full decompression')
+    parser.add_argument('--deep-check', action='store_true',
+                        help='On import failure, also read the first volume of each subject file (slower)')
     
     # Skip options
     parser.add_argument('--skip-setup', action='store_true',
@@ -400,8 +534,16 @@ Examples:
     if not validate_paths(args):
         sys.exit(1)
     
-    # Extract BIDS metadata
-    bids_metadata = extract_bids_metadata(args.bids_dir, script_dir)
+    # Extract BIDS metadata (reuse the cached copy when resuming an existing project)
+    bids_metadata = None
+    if args.skip_setup:
+        bids_metadata = load_cached_bids_metadata(args.project_dir, args.bids_dir)
+        if bids_metadata:
+            log("Using cached BIDS metadata from previous run")
+    if not bids_metadata:
+        bids_metadata = extract_bids_metadata(args.bids_dir)
+        if bids_metadata:
+            save_bids_metadata_cache(args.project_dir, args.bids_dir, bids_metadata)
     
     if bids_metadata:
         num_subjects = bids_metadata.get('num_subjects', 30)
@@ -463,7 +605,7 @@ Examples:
         log(f"Step 2: Import fMRIprep Data", "INFO", Colors.BLUE)
         log("=" * 70, "INFO")
 
-        if not validate_fmriprep_derivatives(args.fmriprep_dir):
+        if not validate_fmriprep_derivatives(args.fmriprep_dir, quick=args.quick_validate):
             sys.exit(1)
         
         import_script_template = os.path.join(batch_script_dir, 'batch_conn_02_import_fmriprep.m')
@@ -476,7 +618,7 @@ Examples:
         }
         
         if create_matlab_script(import_script_template, import_script, substitutions):
-            if not run_matlab_step(2, 'Import fMRIprep Data', import_script, conn_runner, args.project_dir, log_file, fmriprep_dir=args.fmriprep_dir, sessions=sessions):
+            if not run_matlab_step(2, 'Import fMRIprep Data', import_script, conn_runner, args.project_dir, log_file, fmriprep_dir=args.fmriprep_dir, sessions=sessions, deep_check=args.deep_check):
                 sys.exit(1)
         else:
             sys.exit(1)
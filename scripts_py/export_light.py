@@ -2,6 +2,54 @@ import os
 import shutil
 import glob
 
+# Entries left out of the lightweight export (checked with C-level str methods)
+EXCLUDE_NAMES = ("preprocessing",)
+EXCLUDE_SUFFIXES = (".nii",)
+# Per-subject data only excluded directly inside the project's data folder
+DATA_EXCLUDE_PREFIXES = ("DATA_Subject", "VV_DATA_", "BA_Subject")
+
+def _fast_copy(src, dst):
+    """Copy a file in-kernel with os.copy_file_range when possible, keeping metadata like copy2."""
+    in_kernel = hasattr(os, 'copy_file_range')
+    if in_kernel:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        # Some FUSE/network filesystems report 0 instead of failing
+                        in_kernel = False
+                        break
+                    remaining -= copied
+            except OSError:
+                in_kernel = False
+    if not in_kernel:
+        # Not Linux, or unsupported by the filesystem: let shutil pick the
+        # platform's own fast path (fcopyfile on macOS, sendfile on Linux)
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+def _copy_filtered(src_dir, dst_dir, rel_dir="."):
+    """Recursively copy src_dir to dst_dir, skipping excluded entries without statting them."""
+    os.makedirs(dst_dir)
+    is_data_dir = rel_dir == "data"
+    with os.scandir(src_dir) as it:
+        for entry in it:
+            name = entry.name
+            if name in EXCLUDE_NAMES or name.endswith(EXCLUDE_SUFFIXES):
+                continue
+            if is_data_dir and name.startswith(DATA_EXCLUDE_PREFIXES):
+                continue
+            
+            dst_path = os.path.join(dst_dir, name)
+            if entry.is_dir():
+                child_rel = name if rel_dir == "." else os.path.join(rel_dir, name)
+                _copy_filtered(entry.path, dst_path, child_rel)
+            else:
+                _fast_copy(entry.path, dst_path)
+    shutil.copystat(src_dir, dst_dir)
+
 def export_light(project_mat, dest_dir):
     project_mat = os.path.abspath(project_mat)
     dest_dir = os.path.abspath(dest_dir)
@@ -23,35 +71,18 @@ def export_light(project_mat, dest_dir):
 
     # 1. Copy the main .mat file
     print("Copying project file...")
-    shutil.copy2(project_mat, dest_dir)
+    _fast_copy(project_mat, os.path.join(dest_dir, os.path.basename(project_mat)))
 
     # 2. Copy structure with exclusions
     dest_project_dir = os.path.join(dest_dir, project_name)
     
-    def ignore_files(dir, files):
-        rel_dir = os.path.relpath(dir, project_dir)
-        ignored = []
-        
-        # Exclude patterns
-        for f in files:
-            # Absolute exclusions
-            if f == "preprocessing": ignored.append(f)
-            if f.endswith(".nii"): ignored.append(f)
-            
-            # Data folder specific exclusions
-            if rel_dir == "data":
-                if f.startswith("DATA_Subject") or f.startswith("VV_DATA_") or f.startswith("BA_Subject"):
-                    ignored.append(f)
-        
-        return ignored
-
     print("Syncing results and ROI data...")
-    # Since shutil.copytree requires the dest not to exist, we handle merge manually or clear it
+    # The filtered copy creates the destination itself, so clear any previous export
     if os.path.exists(dest_project_dir):
         print("Warning: Destination project folder already exists. Overwriting...")
         shutil.rmtree(dest_project_dir)
         
-    shutil.copytree(project_dir, dest_project_dir, ignore=ignore_files)
+    _copy_filtered(project_dir, dest_project_dir)
 
     print("--- Export Complete ---")
 
@@ -7,6 +7,7 @@ Extracts TR, number of subjects, and other acquisition parameters from BIDS data
 import os
 import json
 import sys
+from functools import cached_property
 from pathlib import Path
 from typing import Dict, List, Tuple, Optional
 import glob
@@ -35,6 +36,43 @@ class BIDSMetadataReader:
             print(f"Warning: No dataset_description.json found in {self.bids_dir}", 
                   file=sys.stderr)
     
+    @cached_property
+    def _layout(self) -> Tuple[List[str], List[str]]:
+        """
+        Scan the dataset for subject and session directories (once per reader)
+        
+        Returns:
+            Tuple of (sorted subject IDs, sorted session labels)
+        """
+        subjects = []
+        sessions = set()
+        
+        # Look for sub-* directories and the ses-* directories inside them
+        with os.scandir(self.bids_dir) as it:
+            for entry in it:
+                if entry.name.startswith('sub-') and entry.is_dir():
+                    subjects.append(entry.name)
+                    with os.scandir(entry.path) as sub_it:
+                        sessions.update(e.name for e in sub_it
+                                        if e.name.startswith('ses-') and e.is_dir())
+        
+        return sorted(subjects), sorted(sessions)
+    
+    @cached_property
+    def subjects(self) -> List[str]:
+        """Sorted subject IDs in BIDS format (sub-XXXX)"""
+        return self._layout[0]
+    
+    @cached_property
+    def sessions(self) -> List[str]:
+        """Sorted session labels (ses-XXXX) found under any subject"""
+        return self._layout[1]
+    
+    @cached_property
+    def tr(self) -> Optional[float]:
+        """TR in seconds from the first functional sidecar, or None"""
+        return self.get_tr_from_json_files()
+    
     def get_subjects(self) -> List[str]:
         """
         Get list of subject IDs in BIDS format (sub-XXXX)
@@ -42,14 +80,7 @@ class BIDSMetadataReader:
         Returns:
             List of subject IDs
         """
-        subjects = set()
-        
-        # Look for sub-* directories
-        for item in self.bids_dir.iterdir():
-            if item.is_dir() and item.name.startswith('sub-'):
-                subjects.add(item.name)
-        
-        return sorted(list(subjects))
+        return list(self.subjects)
     
     def get_number_of_subjects(self) -> int:
         """
@@ -58,7 +89,7 @@ class BIDSMetadataReader:
         Returns:
             Number of subjects
         """
-        return len(self.get_subjects())
+        return len(self.subjects)
     
     def get_tr_from_json_files(self) -> Optional[float]:
         """
@@ -67,34 +98,33 @@ class BIDSMetadataReader:
         Returns:
             TR in seconds (float) or None if not found
         """
-        # Search for *_bold.json files (functional data)
-        json_files = list(self.bids_dir.rglob("*_bold.json"))
-        
-        if not json_files:
-            return None
-        
-        # Read the first one found
-        try:
-            with open(json_files[0], 'r') as f:
-                data = json.load(f)
-                if 'RepetitionTime' in data:
-                    return float(data['RepetitionTime'])
-        except (json.JSONDecodeError, IOError, KeyError):
-            pass
+        # Search for *_bold.json files (functional data); stop at the first usable one
+        for json_file in self.bids_dir.rglob("*_bold.json"):
+            try:
+                with open(json_file, 'r') as f:
+                    data = json.load(f)
+                    if 'RepetitionTime' in data:
+                        return float(data['RepetitionTime'])
+            except (json.JSONDecodeError, IOError, KeyError):
+                continue
         
         return None
     
-    def get_acquisition_parameters(self) -> Dict:
+    def get_acquisition_parameters(self, count_bold: bool = False) -> Dict:
         """
         Extract all relevant acquisition parameters from BIDS
         
+        Args:
+            count_bold: Also count functional files ('num_functional_files'),
+                which needs a full recursive scan of the dataset
+        
         Returns:
             Dictionary with acquisition parameters
         """
         parameters = {
             'num_subjects': self.get_number_of_subjects(),
             'subjects': self.get_subjects(),
-            'tr': self.get_tr_from_json_files(),
+            'tr': self.tr,
         }
         
         # Try to extract from dataset_description.json
@@ -108,22 +138,18 @@ class BIDSMetadataReader:
                 pass
         
         # Get number of sessions (if any)
-        sessions = set()
-        for subject_dir in self.bids_dir.glob("sub-*"):
-            for item in subject_dir.iterdir():
-                if item.is_dir() and item.name.startswith('ses-'):
-                    sessions.add(item.name)
-        parameters['sessions'] = sorted(list(sessions))
+        parameters['sessions'] = list(self.sessions)
         
         # Count functional runs
-        bold_count = len(list(self.bids_dir.rglob("*_bold.nii*")))
-        parameters['num_functional_files'] = bold_count
+        if count_bold:
+            bold_count = sum(1 for _ in self.bids_dir.rglob("*_bold.nii*"))
+            parameters['num_functional_files'] = bold_count
         
         return parameters
     
     def print_summary(self):
         """Print a summary of BIDS dataset"""
-        params = self.get_acquisition_parameters()
+        params = self.get_acquisition_parameters(count_bold=True)
         
         print("\n" + "="*60)
         print("BIDS DATASET SUMMARY")
@@ -165,7 +191,7 @@ def extract_bids_metadata(bids_dir: str) -> Dict:
     """
     try:
         reader = BIDSMetadataReader(bids_dir)
-        return reader.get_acquisition_parameters()
+        return reader.get_acquisition_parameters(count_bold=True)
     except Exception as e:
         print(f"Error reading BIDS metadata: {e}", file=sys.stderr)
         return {}
@@ -184,7 +210,7 @@ if __name__ == "__main__":
     
     try:
         reader = BIDSMetadataReader(bids_dir)
-        params = reader.get_acquisition_parameters()
+        params = reader.get_acquisition_parameters(count_bold=True)
         
         if output_json:
             # Output as JSON for easy parsing in bash/MATLAB
@@ -1,98 +1,284 @@
 import os
+import errno
+import mmap
 import shutil
+import stat
+import tempfile
 import re
-import glob
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+
+# Session label in a transform file name
+_SES_RE = re.compile(r'ses-([a-zA-Z0-9]+)')
+
+def _subject_jsons(sub_path):
+    """ List the JSON sidecars anywhere under a subject folder """
+    sep = os.sep
+    return [root + sep + f
+            for root, dirs, files in os.walk(sub_path)
+            for f in files if f.endswith(".json")]
+
+def _move(src, dst):
+    """ Rename src to dst, falling back to a copy only when they are on different filesystems """
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+# A rewrite rule is (needle, pattern, repl): pattern.sub(repl) does the rewrite
+# and needle is a literal every match contains, for a cheap first check.
+# The names are ASCII BIDS entities, so the encoded patterns match the
+# UTF-8 file contents directly and nothing has to be decoded.
+
+def _flatten_rules(sub, ses):
+    """ Rewrite rules for the sidecars and the report of a flattened single-session subject """
+    sub_b, ses_b = sub.encode('utf-8'), ses.encode('utf-8')
+    sub_re, ses_re = re.escape(sub_b), re.escape(ses_b)
+    needle = sub_b + b'_' + ses_b + b'_'
+
+    # ses/anat/sub_ses_ -> anat/sub_, and any other sub_ses_ -> sub_
+    json_rule = (needle,
+                 re.compile(rb'(?P<dir>%s/anat/)?%s_%s_' % (ses_re, sub_re, ses_re)),
+                 lambda m: (b'anat/' if m['dir'] else b'') + sub_b + b'_')
+    # sub/ses/anat/sub_ses_ -> sub/anat/sub_, and sub_ses_acq-mprage -> sub_acq-mprage
+    html_rule = (needle,
+                 re.compile(rb'(?P<dir>%s/%s/anat/)%s_%s_|%s_%s_(?=acq-mprage)'
+                            % (sub_re, ses_re, sub_re, ses_re, sub_re, ses_re)),
+                 lambda m: (sub_b + b'/anat/' if m['dir'] else b'') + sub_b + b'_')
+    return json_rule, html_rule
+
+def _session_rules(sub, sessions):
+    """ Rewrite rules pointing a subject's sidecars and report at sub/ses-X/anat for the given sessions """
+    sub_b = sub.encode('utf-8')
+    sub_re = re.escape(sub_b)
+    ses_alt = b'|'.join(re.escape(ses.encode('utf-8')) for ses in sessions)
+
+    def json_repl(m):
+        ses = m['ses']
+        # Leave references that already go through the session folder, such as
+        # the sub/ses/anat/... Sources fMRIPrep writes, as they are
+        start = m.start()
+        if m.string[max(0, start - len(ses) - 1):start] == ses + b'/':
+            return m[0]
+        return ses + b'/anat/' + sub_b + b'_' + ses + b'_'
+
+    # anat/sub_ses_ -> ses/anat/sub_ses_
+    json_rule = (b'anat/' + sub_b + b'_',
+                 re.compile(rb'anat/%s_(?P<ses>%s)_' % (sub_re, ses_alt)),
+                 json_repl)
+    # sub/anat/sub_ses_ -> sub/ses/anat/sub_ses_
+    html_rule = (sub_b + b'/anat/' + sub_b + b'_',
+                 re.compile(rb'%s/anat/%s_(?P<ses>%s)_' % (sub_re, sub_re, ses_alt)),
+                 lambda m: sub_b + b'/' + m['ses'] + b'/anat/' + sub_b + b'_' + m['ses'] + b'_')
+    return json_rule, html_rule
+
+def _replace_in_file(path, rule):
+    """ Apply a rewrite rule in one pass, leaving files without its needle untouched """
+    needle, pattern, repl = rule
+    # Sidecars in DataLad/git-annex trees are often symlinks; rewrite the target
+    path = os.path.realpath(path)
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if st.st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            # Most files need no change; an mmap search rejects those without reading them
+            if m.find(needle) < 0:
+                return
+
+            # Every rewrite changes the length, so it cannot be done in place.
+            # The output is streamed from the mapping into a temp file next to
+            # the original; a large report is never held in memory as a whole.
+            out = None
+            pos = 0
+            try:
+                with memoryview(m) as view:
+                    for match in pattern.finditer(m):
+                        new = repl(match)
+                        if new == match[0]:
+                            continue
+                        if out is None:
+                            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+                            out = os.fdopen(fd, 'wb')
+                        out.write(view[pos:match.start()])
+                        out.write(new)
+                        pos = match.end()
+                    if out is None:
+                        return
+                    out.write(view[pos:])
+                out.close()
+            except BaseException:
+                if out is not None:
+                    out.close()
+                    os.unlink(tmp_path)
+                raise
+
+    # Swap the file in only after the original is closed (Windows cannot
+    # replace a file that is still open), keeping its permission bits and owner
+    keep_inode = st.st_nlink > 1
+    if not keep_inode and hasattr(os, 'chown'):
+        try:
+            os.chown(tmp_path, st.st_uid, st.st_gid)
+        except PermissionError:
+            keep_inode = True
+    if not keep_inode:
+        os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+        os.replace(tmp_path, path)
+        return
+
+    # Hard-linked, or owned by someone else: a new inode would break the links
+    # or change the owner, so write the result through the original file
+    try:
+        with open(tmp_path, 'rb') as src, open(path, 'r+b') as dst:
+            shutil.copyfileobj(src, dst)
+            dst.truncate()
+    finally:
+        os.unlink(tmp_path)
+
+def _standardize_subject(base_dir, html_reports, sub, sub_path, ses):
+    """ Flatten a single-session subject's anat folder to sub/anat and return the rewrite jobs """
+    ses_anat_dir = os.path.join(sub_path, ses, 'anat')
+    sub_anat_dir = os.path.join(sub_path, 'anat')
+
+    # The listing is taken before anything is moved out of the folder
+    try:
+        with os.scandir(ses_anat_dir) as it:
+            entries = list(it)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+    print(f"Standardizing single-session subject: {sub}")
+    os.makedirs(sub_anat_dir, exist_ok=True)
+
+    # sub/anat did not exist before, so the moved files are all it holds
+    moved_jsons = []
+    sub_anat_prefix = sub_anat_dir + os.sep
+    for entry in entries:
+        if not entry.is_file():
+            continue
+
+        if entry.name.endswith('xfm.txt'):
+            continue
+
+        new_name = entry.name.replace(f"_{ses}_", "_")
+        new_path = sub_anat_prefix + new_name
+        _move(entry.path, new_path)
+        # Hidden files (e.g. macOS ._ resource forks) were never matched by *.json
+        if new_name.endswith('.json') and not new_name.startswith('.'):
+            moved_jsons.append(new_path)
+
+    json_rule, html_rule = _flatten_rules(sub, ses)
+    # Update references in JSONs
+    jobs = [(json_file, json_rule) for json_file in moved_jsons]
+
+    # Update HTML reports
+    if f"{sub}.html" in html_reports:
+        jobs.append((os.path.join(base_dir, f"{sub}.html"), html_rule))
+    return jobs
+
+def _relocate_transforms(base_dir, html_reports, sub, sub_path):
+    """ Move session-specific transforms from sub/anat into sub/ses-X/anat and return the rewrite jobs """
+    sep = os.sep
+    try:
+        with os.scandir(sub_path + sep + 'anat') as it:
+            files = [e for e in it if not e.is_dir()]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+    moved_sessions = set()
+    for entry in files:
+        f = entry.name
+        if "_ses-" in f and f.endswith("_xfm.txt"):
+            match = _SES_RE.search(f)
+            if match:
+                ses = f"ses-{match.group(1)}"
+                target_ses_anat = f"{sub_path}{sep}{ses}{sep}anat"
+                # Sessions usually hold several transforms; create the folder once
+                if ses not in moved_sessions:
+                    os.makedirs(target_ses_anat, exist_ok=True)
+
+                print(f"Ensuring co-registration transform is in session folder: {sub}/{ses}")
+                _move(entry.path, target_ses_anat + sep + f)
+                moved_sessions.add(ses)
+
+    if not moved_sessions:
+        return []
+    # The references only depend on the session, so each file is rewritten
+    # once per subject with one pattern covering every session that had a move
+    json_rule, html_rule = _session_rules(sub, sorted(moved_sessions))
+
+    jobs = []
+    # Correct HTML references
+    if f"{sub}.html" in html_reports:
+        jobs.append((os.path.join(base_dir, f"{sub}.html"), html_rule))
+
+    # Correct JSON references (every sidecar of the subject)
+    jobs.extend((json_p, json_rule) for json_p in _subject_jsons(sub_path))
+    return jobs
+
+def _reorganize_subject(base_dir, html_reports, sub_entry):
+    """ Run both reorganization steps on one subject folder and return the rewrite jobs """
+    sub = sub_entry.name
+    sub_path = sub_entry.path
+    with os.scandir(sub_path) as it:
+        entries = list(it)
+    sessions = [e.name for e in entries if e.name.startswith('ses-') and e.is_dir()]
+
+    # 1. Single-session subjects get their session anat folder flattened.
+    # That leaves no transforms in sub/anat, so step 2 has nothing to do.
+    if len(sessions) == 1 and not any(e.name == 'anat' for e in entries):
+        return _standardize_subject(base_dir, html_reports, sub, sub_path, sessions[0])
+
+    # 2. Ensure session-specific anatomical transforms
+    return _relocate_transforms(base_dir, html_reports, sub, sub_path)
 
 def reorganize_data(base_dir):
     print(f"Starting reorganization in {base_dir}...")
-    
-    # 1. Identify and process single-session subjects
-    subjects = [d for d in os.listdir(base_dir) if d.startswith('sub-') and os.path.isdir(os.path.join(base_dir, d))]
-    
-    for sub in subjects:
-        sub_path = os.path.join(base_dir, sub)
-        sessions = [d for d in os.listdir(sub_path) if d.startswith('ses-') and os.path.isdir(os.path.join(sub_path, d))]
-        
-        if len(sessions) == 1:
-            ses = sessions[0]
-            ses_dir = os.path.join(sub_path, ses)
-            ses_anat_dir = os.path.join(ses_dir, 'anat')
-            sub_anat_dir = os.path.join(sub_path, 'anat')
-            
-            if not os.path.exists(sub_anat_dir) and os.path.exists(ses_anat_dir):
-                print(f"Standardizing single-session subject: {sub}")
-                os.makedirs(sub_anat_dir, exist_ok=True)
-                
-                for f in os.listdir(ses_anat_dir):
-                    f_path = os.path.join(ses_anat_dir, f)
-                    if not os.path.isfile(f_path):
-                        continue
-                        
-                    if f.endswith('xfm.txt'):
-                        continue
-                    
-                    new_name = f.replace(f"_{ses}_", "_")
-                    shutil.move(f_path, os.path.join(sub_anat_dir, new_name))
-                
-                # Update references in JSONs
-                for json_file in glob.glob(os.path.join(sub_anat_dir, "*.json")):
-                    with open(json_file, 'r', encoding='utf-8') as file:
-                        content = file.read()
-                    
-                    content = content.replace(f"{ses}/anat/{sub}_{ses}_", f"anat/{sub}_")
-                    content = content.replace(f"{sub}_{ses}_", f"{sub}_")
-                    
-                    with open(json_file, 'w', encoding='utf-8') as file:
-                        file.write(content)
-                
-                # Update HTML reports
-                html_file = os.path.join(base_dir, f"{sub}.html")
-                if os.path.exists(html_file):
-                    with open(html_file, 'r', encoding='utf-8') as file:
-                        content = file.read()
-                    
-                    content = content.replace(f"{sub}/{ses}/anat/{sub}_{ses}_", f"{sub}/anat/{sub}_")
-                    content = content.replace(f"{sub}_{ses}_acq-mprage", f"{sub}_acq-mprage")
-                    
-                    with open(html_file, 'w', encoding='utf-8') as file:
-                        file.write(content)
 
-    # 2. Ensure session-specific anatomical transforms
-    for root, dirs, files in os.walk(base_dir):
-        if os.path.basename(root) == 'anat':
-            sub_path = os.path.dirname(root)
-            sub = os.path.basename(sub_path)
-            
-            for f in files:
-                if "_ses-" in f and f.endswith("_xfm.txt"):
-                    match = re.search(r'ses-([a-zA-Z0-9]+)', f)
-                    if match:
-                        ses = f"ses-{match.group(1)}"
-                        target_ses_anat = os.path.join(sub_path, ses, 'anat')
-                        os.makedirs(target_ses_anat, exist_ok=True)
-                        
-                        print(f"Ensuring co-registration transform is in session folder: {sub}/{ses}")
-                        shutil.move(os.path.join(root, f), os.path.join(target_ses_anat, f))
-                        
-                        # Correct HTML references
-                        html_file = os.path.join(base_dir, f"{sub}.html")
-                        if os.path.exists(html_file):
-                            with open(html_file, 'r', encoding='utf-8') as file:
-                                content = file.read()
-                            content = content.replace(f"{sub}/anat/{sub}_{ses}_", f"{sub}/{ses}/anat/{sub}_{ses}_")
-                            with open(html_file, 'w', encoding='utf-8') as file:
-                                file.write(content)
-                        
-                        # Correct JSON references (walk through sub folder)
-                        for r, d, f_list in os.walk(sub_path):
-                            for jf in f_list:
-                                if jf.endswith(".json"):
-                                    json_p = os.path.join(r, jf)
-                                    with open(json_p, 'r', encoding='utf-8') as file:
-                                        content = file.read()
-                                    content = content.replace(f"anat/{sub}_{ses}_", f"{ses}/anat/{sub}_{ses}_")
-                                    with open(json_p, 'w', encoding='utf-8') as file:
-                                        file.write(content)
+    # scandir entries carry the dirent type, so is_dir() needs no extra stat.
+    # The subject reports live next to the subject folders and are never
+    # created or removed here, so one listing answers every existence check.
+    with os.scandir(base_dir) as it:
+        entries = list(it)
+    subjects = [e for e in entries if e.name.startswith('sub-') and e.is_dir()]
+    html_reports = {e.name for e in entries if e.name.endswith('.html') and e.is_file()}
+
+    # Subjects are independent and the work is syscall-bound, so they fan
+    # out over a thread pool. Each subject and its report belong to one task,
+    # so no two tasks ever touch the same file.
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        task = partial(_reorganize_subject, base_dir, html_reports)
+        moves = {executor.submit(task, sub_entry): sub_entry.name for sub_entry in subjects}
+
+        # A few subjects can own most of the sidecars, so the rewrites are spread
+        # over the pool as individual files rather than one subject per worker.
+        # Each subject's rewrites are queued as soon as its own files are moved,
+        # so a failing subject never leaves the others moved but not rewritten.
+        rewrites = {}
+        for future in as_completed(moves):
+            sub = moves[future]
+            try:
+                jobs = future.result()
+            except Exception as e:
+                print(f"Error reorganizing {sub}: {e}")
+                errors.append(e)
+                continue
+            for path, rule in jobs:
+                rewrites[executor.submit(_replace_in_file, path, rule)] = path
+
+        for future in as_completed(rewrites):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error updating references in {rewrites[future]}: {e}")
+                errors.append(e)
+
+    if errors:
+        raise errors[0]
 
     print("Reorganization complete.")
 
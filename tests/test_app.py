@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+flask = pytest.importorskip("flask")
+import app
+
+
+def test_ls_lists_non_utf8_file_names(tmp_path):
+    # A name that is not valid UTF-8 is legal on Linux; os.scandir hands it
+    # back with surrogate escapes, which orjson refuses to serialize
+    try:
+        open(os.path.join(os.fsencode(tmp_path), b"caf\xe9.txt"), "wb").close()
+    except OSError:
+        pytest.skip("filesystem rejects non-UTF-8 file names")
+
+    response = app.app.test_client().get("/api/ls", query_string={"path": str(tmp_path)})
+
+    assert response.status_code == 200
+    names = [item["name"] for item in response.get_json()["items"]]
+    assert names == [os.fsdecode(b"caf\xe9.txt")]